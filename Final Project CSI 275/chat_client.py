@@ -6,12 +6,12 @@ communication with other connected clients. The client handles various types
 of messages and events. When the client is started, it prompts the user to
 enter a screen name, which serves as their identifier in the chat room. The
 client then establishes a connection to the specified chat server using the
-provided host and port information. Once connected, the client creates a
-separate thread for receiving messages from the server. This thread
-continuously listens for incoming messages and processes them based on
-their type. The client supports handling broadcast messages, private messages,
-join and leave announcements, and error messages. The main thread of the
-client handles user input and sends messages to the server. Users can send
+provided host and port information. Once connected, the client runs an
+asyncio event loop that waits on both the server connection and the keyboard.
+Incoming messages are processed based on their type as soon as they arrive.
+The client supports handling broadcast messages, private messages,
+join and leave announcements, and error messages. Each line the user types
+is sent to the server as soon as it is entered. Users can send
 broadcast messages to all connected clients by simply typing their message and
 pressing enter. They can also send private messages to a specific recipient by
 using the "@" symbol followed by the recipient's screen name. The client
@@ -31,11 +31,13 @@ assignment may, for the purpose of assessing this assignment:
 - the purpose of future plagiarism checking)
 """
 
-import socket
-import json
-import struct
+import asyncio
+import sys
 import threading
 
+from chat_protocol import (BROADCAST, PRIVATE, START, EXIT, JOIN, LEAVE,
+                           USER_LIST, ERROR, encode, decode)
+
 
 class ChatClient:
     """A client for connecting to a chat server and exchanging messages."""
@@ -45,125 +47,193 @@ class ChatClient:
         self.server_host = server_host
         self.server_port = server_port
         self.screen_name = screen_name
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((self.server_host, self.server_port))
+        self.reader = None
+        self.writer = None
+        self.connected = False
+
+    async def connect(self):
+        """Open the connection to the chat server."""
+        # asyncio transports disable Nagle's algorithm, so each message is
+        # sent immediately
+        self.reader, self.writer = await asyncio.open_connection(
+            self.server_host, self.server_port)
         self.connected = True
 
     def send_message(self, msg_type, message, recipient=None):
         """Send a message to the chat server."""
-        msg = ""
+        frame = b''
         if msg_type == 'START':
             # Create a START message with the client's screen name
-            msg = json.dumps(['START', self.screen_name])
+            frame = encode(START, self.screen_name)
         elif msg_type == 'BROADCAST':
             # Create a BROADCAST message with
             # the client's screen name and message
-            msg = json.dumps(['BROADCAST', self.screen_name, message])
+            frame = encode(BROADCAST, self.screen_name, message)
         elif msg_type == 'PRIVATE':
             # Create a PRIVATE message with the client's
             # screen name, message, and recipient
-            msg = json.dumps(['PRIVATE', self.screen_name, message,
-                              recipient])
+            frame = encode(PRIVATE, self.screen_name, message, recipient)
         elif msg_type == 'EXIT':
             # Create an EXIT message with the client's screen name
-            msg = json.dumps(['EXIT', self.screen_name])
+            frame = encode(EXIT, self.screen_name)
 
-        # Encode the message and send it to the server
-        msg_bytes = msg.encode('utf-8')
-        msg_len = len(msg_bytes)
-        # https://docs.python.org/3/library/struct.html
-        msg_len_bytes = struct.pack('!I', msg_len)
-        self.sock.send(msg_len_bytes + msg_bytes)
+        # Send the encoded message to the server
+        self.writer.write(frame)
 
         if msg_type == 'EXIT':
             # If the message is an EXIT message,
-            # close the socket and set connected to False
+            # close the connection and set connected to False
             self.connected = False
-            self.sock.close()
+            self.writer.close()
 
-    def receive_messages(self):
+    async def receive_messages(self):
         """Receive and process messages from the chat server."""
         # Send a START message to the server to indicate the client has joined
         self.send_message('START', None)
-        while self.connected:
-            try:
+        try:
+            while self.connected:
                 # Receive the message length
-                msg_len_bytes = self.sock.recv(4)
-                if not msg_len_bytes:
-                    break
-                # https://docs.python.org/3/library/struct.html
-                msg_len = struct.unpack('!I', msg_len_bytes)[0]
+                msg_len_bytes = await self.reader.readexactly(4)
+                # See int.from_bytes in
+                # https://docs.python.org/3/library/stdtypes.html
+                msg_len = int.from_bytes(msg_len_bytes, 'big')
 
                 # Receive the message data
-                msg_data = self.sock.recv(msg_len).decode('utf-8')
-                msg = json.loads(msg_data)
+                msg_type, fields = decode(
+                    await self.reader.readexactly(msg_len))
 
                 # Process the received message based on its type
-                if msg[0] == 'BROADCAST':
+                text = ''
+                if msg_type == BROADCAST:
                     # Display a broadcast message
-                    sender, message = msg[1], msg[2]
-                    print(f"{sender}: {message}")
-                elif msg[0] == 'PRIVATE':
+                    sender, message = fields
+                    text = f"{sender}: {message}\n"
+                elif msg_type == PRIVATE:
                     # Display a private message
-                    sender, message = msg[1], msg[2]
-                    print(f"{sender} (private): {message}")
-                elif msg[0] == 'JOIN':
+                    sender, message = fields
+                    text = f"{sender} (private): {message}\n"
+                elif msg_type == JOIN:
                     # Display a join message when a client joins the chat
-                    screen_name = msg[1]
-                    print(f"{screen_name} has joined the chat")
-                elif msg[0] == 'LEAVE':
+                    screen_name = fields[0]
+                    text = f"{screen_name} has joined the chat\n"
+                elif msg_type == LEAVE:
                     # Display a leave message when a client leaves the chat
-                    screen_name = msg[1]
-                    print(f"{screen_name} has left the chat")
-                elif msg[0] == 'USER_LIST':
+                    screen_name = fields[0]
+                    text = f"{screen_name} has left the chat\n"
+                elif msg_type == USER_LIST:
                     # Receive the list of connected users
-                    user_list = msg[1]
-                    print("Connected users:")
-                    for user in user_list:
-                        print(user)
-                elif msg[0] == 'ERROR':
+                    user_list = fields
+                    text = "Connected users:\n" + "".join(
+                        f"{user}\n" for user in user_list)
+                elif msg_type == ERROR:
                     # Display an error message
-                    print(f"Error: {msg[1]}")
-
-                # Display the prompt for the next message
-                print("> ", end="", flush=True)
-            except (ConnectionResetError, ConnectionAbortedError, OSError):
-                # Handle connection errors
-                print('Disconnected from the server')
-                self.connected = False
-                break
+                    text = f"Error: {fields[0]}\n"
+
+                # Display the message and the prompt for the next message
+                # with a single write to the terminal
+                sys.stdout.write(text + "> ")
+                sys.stdout.flush()
+        except asyncio.IncompleteReadError:
+            # The connection was closed, either by us or by the server
+            self.connected = False
+        except (ConnectionResetError, ConnectionAbortedError, OSError,
+                ValueError):
+            # Handle connection errors and messages that cannot be decoded
+            print('Disconnected from the server')
+            self.connected = False
 
-    def start(self):
-        """Start the chat client and handle user input."""
-        # Create a separate thread for receiving messages
-        receive_thread = threading.Thread(target=self.receive_messages)
-        receive_thread.start()
+    def handle_input(self, message):
+        """Send a line of user input to the chat server."""
+        if not message:
+            # Standard input was closed, so leave the chat
+            self.send_message('EXIT', None)
+            return
+        message = message.rstrip('\n')
 
         try:
-            while self.connected:
-                # Read user input
-                message = input("> ")
-
-                if message.startswith("@"):
-                    # If the message starts with "@", it's a private message
-                    recipient, message = message.split(" ", 1)
-                    recipient = recipient[1:]
-                    self.send_message('PRIVATE', message, recipient)
-                elif message == "!exit":
-                    # If the message is "!exit", send an EXIT message
-                    # and break the loop
-                    self.send_message('EXIT', None)
-                    break
+            if message.startswith("@"):
+                # If the message starts with "@", it's a private message
+                recipient, _, message = message.partition(" ")
+                if message:
+                    self.send_message('PRIVATE', message, recipient[1:])
                 else:
-                    # Otherwise, send a broadcast message
-                    self.send_message('BROADCAST', message)
-        except KeyboardInterrupt:
+                    print("Usage: @name message")
+            elif message == "!exit":
+                # If the message is "!exit", send an EXIT message
+                self.send_message('EXIT', None)
+                return
+            else:
+                # Otherwise, send a broadcast message
+                self.send_message('BROADCAST', message)
+        except ValueError as error:
+            # The message or recipient is too long to send
+            print(f"Error: {error}")
+
+        # Display the prompt for the next message
+        print("> ", end="", flush=True)
+
+    @staticmethod
+    def _read_stdin(loop, lines):
+        """Pass each line typed by the user to the event loop."""
+        while True:
+            line = sys.stdin.readline()
+            try:
+                loop.call_soon_threadsafe(lines.put_nowait, line)
+            except RuntimeError:
+                # The event loop has already closed
+                break
+            if not line:
+                break
+
+    async def read_input(self):
+        """Read lines of user input until the client disconnects."""
+        lines = asyncio.Queue()
+        # Wait for each line in a separate thread so the event loop keeps
+        # receiving messages. Unlike loop.add_reader(), this also works with
+        # the Windows console, and since the thread is a daemon, a blocked
+        # readline() does not stop the client from exiting.
+        threading.Thread(target=self._read_stdin,
+                         args=(asyncio.get_running_loop(), lines),
+                         daemon=True).start()
+        while self.connected:
+            message = await lines.get()
+            if self.connected:
+                self.handle_input(message)
+
+    async def run(self):
+        """Connect and handle server messages and user input together."""
+        await self.connect()
+        tasks = {asyncio.create_task(self.receive_messages()),
+                 asyncio.create_task(self.read_input())}
+        try:
+            # Stop as soon as either side is done, e.g. the server hung up
+            # or the user typed !exit
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
             # Handle keyboard interrupt (Ctrl+C) and send an EXIT message
-            self.send_message('EXIT', None)
+            if self.connected:
+                self.send_message('EXIT', None)
+            raise
         finally:
-            # Wait for the receiving thread to finish and close the socket
-            receive_thread.join()
-            self.sock.close()
+            for task in tasks:
+                task.cancel()
+            self.writer.close()
+
+        # Report anything that went wrong in the task that finished
+        for task in tasks:
+            if task.done() and not task.cancelled():
+                task.result()
+
+    def start(self):
+        """Start the chat client and handle user input."""
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            # The EXIT message was already sent when run() was cancelled
+            pass
+        except ValueError as error:
+            # The screen name is too long to send to the server
+            print(f'Error: {error}')
 
 
 if __name__ == '__main__':
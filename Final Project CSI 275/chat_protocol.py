@@ -0,0 +1,107 @@
+"""Student code for CSI-275 Final Project.
+
+Description: The chat_protocol.py file defines the binary message format
+shared by chat_server.py and the chat clients. Every message is sent as a
+frame: a 4-byte big-endian length followed by the message body. The body
+starts with a one-byte message type and is followed by the message's text
+fields, each encoded as UTF-8 behind its own big-endian length prefix.
+Keeping the format in one module means the server and every client always
+agree on how messages are framed.
+
+Author: Luke Cutter
+Class: CSI-275-01, Spring 2024
+Assignment: Final Project
+Certification of Authenticity:
+I certify that this is entirely my own work, except where I have given
+fully-documented references to the work of others. I understand the definition
+and consequences of plagiarism and acknowledge that the assessor of this
+assignment may, for the purpose of assessing this assignment:
+- Reproduce this assignment and provide a copy to another member of academic
+- staff; and/or Communicate a copy of this assignment to a plagiarism checking
+- service (which may then retain a copy of this assignment on its database for
+- the purpose of future plagiarism checking)
+"""
+
+# Message types, sent as the first byte of every message
+BROADCAST = 0x01
+PRIVATE = 0x02
+START = 0x03
+EXIT = 0x04
+JOIN = 0x05
+LEAVE = 0x06
+USER_LIST = 0x07
+ERROR = 0x08
+
+# Size in bytes of the length prefix in front of each UTF-8 field, by message
+# type. The last size repeats for any extra fields, e.g. each USER_LIST name.
+_FIELD_SIZES = {
+    BROADCAST: (2, 4),  # sender, message
+    PRIVATE: (2, 4, 2),  # sender, message, recipient (client to server only)
+    START: (2,),  # screen name
+    EXIT: (2,),  # screen name
+    JOIN: (2,),  # screen name
+    LEAVE: (2,),  # screen name
+    USER_LIST: (2,),  # every connected screen name
+    ERROR: (4,),  # error text
+}
+
+# How many fields each message type may carry. USER_LIST can hold any number.
+_FIELD_COUNTS = {
+    BROADCAST: (2,),
+    PRIVATE: (2, 3),  # the recipient is only sent from client to server
+    START: (1,),
+    EXIT: (1,),
+    JOIN: (1,),
+    LEAVE: (1,),
+    ERROR: (1,),
+}
+
+
+def encode(msg_type, *fields):
+    """Encode a message as a frame behind a 4-byte length prefix.
+
+    Raises ValueError if a field is too long for its length prefix.
+    """
+    sizes = _FIELD_SIZES[msg_type]
+    parts = [msg_type.to_bytes(1, 'big')]
+    for i, field in enumerate(fields):
+        data = field.encode('utf-8')
+        size = sizes[min(i, len(sizes) - 1)]
+        if len(data) >= 256 ** size:
+            raise ValueError(f'Field is {len(data)} bytes, but at most '
+                             f'{256 ** size - 1} bytes fit in this message')
+        parts.append(len(data).to_bytes(size, 'big'))
+        parts.append(data)
+    body = b''.join(parts)
+    return len(body).to_bytes(4, 'big') + body
+
+
+def decode(body):
+    """Split a frame body into its message type and list of fields.
+
+    Raises ValueError if the body is not a well-formed message.
+    """
+    view = memoryview(body)
+    if not view:
+        raise ValueError('Empty message')
+    msg_type = view[0]
+    if msg_type not in _FIELD_SIZES:
+        raise ValueError(f'Unknown message type {msg_type}')
+    sizes = _FIELD_SIZES[msg_type]
+    fields = []
+    offset = 1
+    while offset < len(view):
+        size = sizes[min(len(fields), len(sizes) - 1)]
+        if offset + size > len(view):
+            raise ValueError('Field length runs past the end of the message')
+        field_len = int.from_bytes(view[offset:offset + size], 'big')
+        offset += size
+        if offset + field_len > len(view):
+            raise ValueError('Field runs past the end of the message')
+        # Invalid UTF-8 raises UnicodeDecodeError, a subclass of ValueError
+        fields.append(str(view[offset:offset + field_len], 'utf-8'))
+        offset += field_len
+    counts = _FIELD_COUNTS.get(msg_type)
+    if counts is not None and len(fields) not in counts:
+        raise ValueError(f'Wrong number of fields for message type {msg_type}')
+    return msg_type, fields
@@ -2,9 +2,10 @@
 
 Description: The chat_server.py file implements a chat server that allows
 multiple clients to connect and communicate with each other. The server uses
-the TCP protocol and handles client connections using threading. When a
-client connects to the server, a new thread is created to handle the
-communication with that specific client. The server supports various types
+the TCP protocol and handles client connections using asyncio. When a
+client connects to the server, a new coroutine is started on the event loop
+to handle the communication with that specific client, so a single thread
+can serve every connection. The server supports various types
 of messages, including broadcasting messages to all connected clients,
 sending private messages to a specific recipient, and handling client join
 and leave events. The server also gracefully handles connection errors and
@@ -24,145 +25,227 @@ assignment may, for the purpose of assessing this assignment:
 - the purpose of future plagiarism checking)
 """
 
+import asyncio
 import socket
-import json
-import struct
-import threading
+
+from chat_protocol import (BROADCAST, PRIVATE, START, EXIT, JOIN, LEAVE,
+                           USER_LIST, ERROR, encode, decode)
+
+try:
+    # uvloop is a faster drop-in replacement for the asyncio event loop
+    import uvloop
+except ImportError:
+    uvloop = None
 
 
 class ChatServer:
     """Create a TCP server and listen for incoming connections."""
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, max_clients=256):
         """Set up the TCP server and bind it to host and port."""
         self.host = host
         self.port = port
-        # Store who is currently in the server
+        # Store who is currently in the server. Only the event loop thread
+        # touches this, so it needs no lock.
         self.clients = {}
+        # Each client's length-prefixed screen name, and the USER_LIST frame
+        # built from them, which is rebuilt only after someone joins or leaves
+        self._name_fields = {}
+        self._user_list_frame = None
+        # Connections beyond max_clients are turned away with an error
+        self.max_clients = max_clients
+        self._connections = 0
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.bind((self.host, self.port))
 
-    def broadcast(self, message, sender):
+    @staticmethod
+    async def _drain(writer):
+        """Wait for a client's send buffer to empty out."""
+        try:
+            await writer.drain()
+        except (ConnectionResetError, ConnectionAbortedError, OSError):
+            # The client's own handler cleans up after a dead connection
+            pass
+
+    def add_client(self, screen_name, writer):
+        """Remember a client under its screen name."""
+        self.clients[screen_name] = writer
+        name_bytes = screen_name.encode('utf-8')
+        self._name_fields[screen_name] = (len(name_bytes).to_bytes(2, 'big')
+                                          + name_bytes)
+        self._user_list_frame = None
+
+    def remove_client(self, screen_name, writer):
+        """Forget a client if screen_name still belongs to its connection."""
+        # A later client may have reused the name, so check the writer too
+        if self.clients.get(screen_name) is writer:
+            del self.clients[screen_name]
+            del self._name_fields[screen_name]
+            self._user_list_frame = None
+            return True
+        return False
+
+    def user_list_frame(self):
+        """Return the USER_LIST frame naming every connected client."""
+        if self._user_list_frame is None:
+            body = (USER_LIST.to_bytes(1, 'big')
+                    + b''.join(self._name_fields.values()))
+            self._user_list_frame = len(body).to_bytes(4, 'big') + body
+        return self._user_list_frame
+
+    async def broadcast(self, message, sender):
         """Check if message is sent by client and broadcast if not."""
-        for screen_name, client in self.clients.items():
-            if screen_name != sender:
-                client.send(message)
-
-    def send_private(self, message, sender, recipient):
+        writers = [writer for screen_name, writer in self.clients.items()
+                   if screen_name != sender]
+        # Every recipient is handed the same frame object, so nothing is
+        # copied unless a socket cannot take the whole frame right away
+        for writer in writers:
+            writer.write(message)
+
+        # Only recipients with unsent data can apply backpressure, so skip
+        # creating a drain task for everyone else and wait on the rest at once
+        backed_up = [writer for writer in writers
+                     if writer.transport.get_write_buffer_size()]
+        if backed_up:
+            await asyncio.gather(*(self._drain(writer)
+                                   for writer in backed_up))
+
+    async def send_private(self, message, sender_writer, recipient):
         """Send a private message from one client to another."""
         if recipient in self.clients:
-            self.clients[recipient].send(message)
-        # If recipient does not exist, throw an error
+            writer = self.clients[recipient]
+            writer.write(message)
+            await self._drain(writer)
+        # If recipient does not exist, send the sender an error
         else:
-            error_msg = json.dumps(['ERROR', f'Recipient {recipient}'
-                                             f' not found']).encode('utf-8')
-            error_msg_len = len(error_msg)
-            # https://docs.python.org/3/library/struct.html
-            error_msg_len_bytes = struct.pack('!I', error_msg_len)
-            self.clients[sender].send(error_msg_len_bytes + error_msg)
-
-    def handle_client(self, client_sock):
+            sender_writer.write(
+                encode(ERROR, f'Recipient {recipient} not found'))
+            await self._drain(sender_writer)
+
+    async def handle_client(self, reader, writer):
         """Handle communication with a connected client."""
+        # Log in server whenever someone enters. asyncio transports already
+        # disable Nagle's algorithm, so small messages go out immediately.
+        print(f'Accepted connection from {writer.get_extra_info("peername")}')
         client_screen_name = None
+        broadcast_prefix = None
         while True:
             try:
                 # Receive the message length
-                msg_len_bytes = client_sock.recv(4)
-                if not msg_len_bytes:
-                    break
-                # https://docs.python.org/3/library/struct.html
-                msg_len = struct.unpack('!I', msg_len_bytes)[0]
+                msg_len_bytes = await reader.readexactly(4)
+                # See int.from_bytes in
+                # https://docs.python.org/3/library/stdtypes.html
+                msg_len = int.from_bytes(msg_len_bytes, 'big')
 
                 # Receive and decode the message data
-                msg_data = client_sock.recv(msg_len).decode('utf-8')
-                msg = json.loads(msg_data)
+                msg_type, fields = decode(await reader.readexactly(msg_len))
 
                 # Process the received message based on its type
-                if msg[0] == 'START':
+                if msg_type == START:
                     # Client is joining the chat
-                    client_screen_name = msg[1]
-                    self.clients[client_screen_name] = client_sock
+                    client_screen_name = fields[0]
+                    self.add_client(client_screen_name, writer)
                     print(f'Client {client_screen_name} connected')
 
+                    # Encode the type and sender of this client's broadcasts
+                    # only once
+                    broadcast_prefix = (
+                        BROADCAST.to_bytes(1, 'big')
+                        + self._name_fields[client_screen_name])
+
                     # Send the list of connected users to the new client
-                    user_list = list(self.clients.keys())
-                    user_list_msg = json.dumps(['USER_LIST', user_list]).encode('utf-8')
-                    user_list_msg_len = len(user_list_msg)
-                    # https://docs.python.org/3/library/struct.html
-                    user_list_msg_len_bytes = struct.pack('!I', user_list_msg_len)
-                    client_sock.send(user_list_msg_len_bytes + user_list_msg)
+                    writer.write(self.user_list_frame())
+                    await self._drain(writer)
 
                     # Broadcast a join message to all other clients
-                    join_msg = json.dumps(['JOIN', client_screen_name]).encode('utf-8')
-                    join_msg_len = len(join_msg)
-                    # https://docs.python.org/3/library/struct.html
-                    join_msg_len_bytes = struct.pack('!I', join_msg_len)
-                    self.broadcast(join_msg_len_bytes + join_msg, client_screen_name)
-                elif msg[0] == 'BROADCAST':
-                    # Client is sending a broadcast message
-                    client_screen_name, message = msg[1], msg[2]
+                    await self.broadcast(encode(JOIN, client_screen_name),
+                                         client_screen_name)
+                elif msg_type == BROADCAST and broadcast_prefix is not None:
+                    # Client is sending a broadcast message. Clients that
+                    # have not sent START yet have no one to talk to, so
+                    # ignore them.
+                    message = fields[1]
                     print(f'{client_screen_name}: {message}')
 
-                    # Broadcast the message to all other clients
-                    broadcast_msg = json.dumps(['BROADCAST', client_screen_name, message]).encode('utf-8')
-                    broadcast_msg_len = len(broadcast_msg)
-                    # https://docs.python.org/3/library/struct.html
-                    broadcast_msg_len_bytes = struct.pack('!I', broadcast_msg_len)
-                    self.broadcast(broadcast_msg_len_bytes + broadcast_msg, client_screen_name)
-                elif msg[0] == 'PRIVATE':
-                    # Client is sending a private message
-                    sender, recipient, message = msg[1], msg[3], msg[2]
-                    print(f'Private message from {sender} to {recipient}: {message}')
+                    # Broadcast the message to all other clients, only
+                    # encoding the message itself
+                    message_bytes = message.encode('utf-8')
+                    body = (broadcast_prefix
+                            + len(message_bytes).to_bytes(4, 'big')
+                            + message_bytes)
+                    broadcast_msg = len(body).to_bytes(4, 'big') + body
+                    await self.broadcast(broadcast_msg, client_screen_name)
+                elif msg_type == PRIVATE and broadcast_prefix is not None:
+                    # Client is sending a private message. Like broadcasts,
+                    # these are ignored until the client has sent START.
+                    if len(fields) != 3:
+                        raise ValueError('PRIVATE needs a sender, message, '
+                                         'and recipient')
+                    # The sender is whoever started this connection, not the
+                    # name the client put in the message
+                    message, recipient = fields[1], fields[2]
+                    print(f'Private message from {client_screen_name} to '
+                          f'{recipient}: {message}')
 
                     # Send the private message to the recipient
-                    private_msg = json.dumps(['PRIVATE', sender, message]).encode('utf-8')
-                    private_msg_len = len(private_msg)
-                    # https://docs.python.org/3/library/struct.html
-                    private_msg_len_bytes = struct.pack('!I', private_msg_len)
-                    self.send_private(private_msg_len_bytes + private_msg, sender, recipient)
-                elif msg[0] == 'EXIT':
+                    private_msg = encode(PRIVATE, client_screen_name, message)
+                    await self.send_private(private_msg, writer, recipient)
+                elif msg_type == EXIT:
                     # Client is leaving the chat
                     print(f'Client {client_screen_name} disconnected')
-                    del self.clients[client_screen_name]
-
-                    # Broadcast a leave message to all other clients
-                    self.broadcast_leave_message(client_screen_name)
+                    if self.remove_client(client_screen_name, writer):
+                        # Broadcast a leave message to all other clients
+                        await self.broadcast_leave_message(client_screen_name)
 
-                    # Close the client socket and break the loop
-                    client_sock.close()
+                    # Close the client connection and break the loop
+                    writer.close()
                     break
-            except (ConnectionResetError, ConnectionAbortedError, OSError):
-                # Handle connection errors
-                if client_screen_name in self.clients:
+            except (asyncio.IncompleteReadError, ConnectionResetError,
+                    ConnectionAbortedError, OSError, ValueError):
+                # Handle connection errors, including the client hanging up
+                # or sending a message that cannot be decoded
+                if self.remove_client(client_screen_name, writer):
                     print(f'Client {client_screen_name} disconnected')
-                    del self.clients[client_screen_name]
 
                     # Broadcast a leave message to all other clients
-                    self.broadcast_leave_message(client_screen_name)
+                    await self.broadcast_leave_message(client_screen_name)
 
-                # Close the client socket and break the loop
-                client_sock.close()
+                # Close the client connection and break the loop
+                writer.close()
                 break
 
-    def broadcast_leave_message(self, client_screen_name):
+    async def _handle_client_if_room(self, reader, writer):
+        """Handle a client, or turn it away if the server is full."""
+        if self._connections >= self.max_clients:
+            peer = writer.get_extra_info('peername')
+            print(f'Rejected connection from {peer}')
+            writer.write(encode(ERROR, 'Server full'))
+            writer.close()
+            return
+        self._connections += 1
+        try:
+            await self.handle_client(reader, writer)
+        finally:
+            self._connections -= 1
+
+    async def broadcast_leave_message(self, client_screen_name):
         """Broadcast a leave message to all other clients."""
-        leave_msg = json.dumps(['LEAVE', client_screen_name]).encode('utf-8')
-        leave_msg_len = len(leave_msg)
-        # https://docs.python.org/3/library/struct.html
-        leave_msg_len_bytes = struct.pack('!I', leave_msg_len)
-        self.broadcast(leave_msg_len_bytes + leave_msg, client_screen_name)
+        await self.broadcast(encode(LEAVE, client_screen_name),
+                             client_screen_name)
+
+    async def serve(self):
+        """Serve every client connection on the running event loop."""
+        server = await asyncio.start_server(self._handle_client_if_room,
+                                            sock=self.sock)
+        async with server:
+            await server.serve_forever()
 
     def accept_connections(self):
         """Accept connection and display when connected to the server."""
-        self.sock.listen()
-        while True:
-            client_sock, _ = self.sock.accept()
-            # Log in server whenever someone enters
-            print(f'Accepted connection from {client_sock.getpeername()}')
-            # Make a new thread for the new client
-            client_handler = threading.Thread(target=self.handle_client,
-                                              args=(client_sock,))
-            client_handler.start()
+        # asyncio's default loop already waits on sockets with epoll on Linux,
+        # kqueue on macOS, and IOCP on Windows
+        run = asyncio.run if uvloop is None else uvloop.run
+        run(self.serve())
 
 
 if __name__ == '__main__':